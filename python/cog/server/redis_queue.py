@@ -1,37 +1,84 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 import io
 import json
+import math
+import os
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple
 import signal
+import socket
 import sys
 import traceback
 import time
 import types
 import contextlib
 
+import orjson
 from pydantic import ValidationError
 import redis
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
 
 from ..predictor import BasePredictor, get_input_type, load_predictor
 from ..json import encode_json
 from ..response import Status
 from .runner import PredictionRunner
 
+# plain strings, so encoding a response doesn't have to go through the enum
+STATUS_PROCESSING = Status.PROCESSING.value
+STATUS_SUCCEEDED = Status.SUCCEEDED.value
+STATUS_FAILED = Status.FAILED.value
+
+# the response for a failed prediction, with the JSON-encoded error message
+# formatted into it
+ERROR_RESPONSE_TEMPLATE = b'{"status":"failed","error":%s}'
+
+
+def dumps_response(response: Dict[str, Any]) -> bytes:
+    """
+    Encodes a response with orjson, falling back to `json.dumps()` for
+    anything orjson encodes differently or can't encode, like NaN and
+    Infinity or ints that don't fit in 64 bits.
+    """
+    # orjson encodes NaN and Infinity as null, where `json.dumps()` sends them
+    # as they are
+    if has_non_finite_float(response):
+        return json.dumps(response).encode("utf-8")
+    try:
+        # OPT_NON_STR_KEYS so outputs with non-string keys encode like they
+        # would with `json.dumps()`
+        return orjson.dumps(response, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        return json.dumps(response).encode("utf-8")
+
+
+def has_non_finite_float(obj: Any) -> bool:
+    """
+    Returns True if `obj` is, or contains, a NaN or infinite float.
+    """
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(has_non_finite_float(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(has_non_finite_float(value) for value in obj)
+    return False
+
 
 class timeout:
     """A context manager that times out after a given number of seconds."""
 
     def __init__(
         self,
-        seconds: Optional[int],
-        elapsed: Optional[int] = None,
+        seconds: Optional[float],
+        elapsed: Optional[float] = None,
         error_message: str = "Prediction timed out",
     ) -> None:
         if elapsed is None or seconds is None:
             self.seconds = seconds
         else:
-            self.seconds = seconds - int(elapsed)
+            self.seconds = seconds - elapsed
         self.error_message = error_message
 
     def handle_timeout(self, signum: Any, frame: Any) -> None:
@@ -43,11 +90,139 @@ class timeout:
                 self.handle_timeout(None, None)
             else:
                 signal.signal(signal.SIGALRM, self.handle_timeout)
-                signal.alarm(self.seconds)
+                # setitimer rather than alarm, which only takes whole seconds
+                signal.setitimer(signal.ITIMER_REAL, self.seconds)
 
     def __exit__(self, type: Any, value: Any, traceback: Any) -> None:
         if self.seconds is not None:
-            signal.alarm(0)
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ResponseSender:
+    """
+    Sends a prediction's progress to its response queue as deltas: each
+    message only contains the output produced since the previous one.
+
+    Logs are added to a Redis stream named after the response queue and the
+    prediction's ID instead, so consumers can read them from wherever they
+    left off. The stream expires `logs_stream_ttl` seconds after the last
+    log line. Messages while the prediction is processing are only sent when
+    there's new output.
+
+    Output and logs are buffered until `max_items` of them are waiting or
+    `max_wait` seconds have passed since the last send, so chatty
+    predictors don't cost a round trip per log line.
+
+    Output is added as futures, so it can be encoded (and any files
+    uploaded) in the background. The futures are resolved just before the
+    message containing them is sent.
+    """
+
+    LOGS_STREAM_SUFFIX = ":logs"
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        response_queue: str,
+        max_items: int,
+        max_wait: float,
+        logs_stream_length: int,
+        logs_stream_ttl: int,
+        prediction_id: Optional[str] = None,
+    ) -> None:
+        self.redis = redis_client
+        self.response_queue = response_queue
+        self.logs_stream = response_queue + self.LOGS_STREAM_SUFFIX
+        if prediction_id is not None:
+            self.logs_stream += f":{prediction_id}"
+        self.logs_stream_length = logs_stream_length
+        self.logs_stream_ttl = logs_stream_ttl
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.seq = 0
+        self.pending_output: List["Future[Any]"] = []
+        self.pending_logs: List[str] = []
+        self.last_flush = time.monotonic()
+
+    def add(
+        self,
+        output: Optional[List["Future[Any]"]] = None,
+        logs: Optional[List[str]] = None,
+    ) -> None:
+        if output:
+            self.pending_output.extend(output)
+        if logs:
+            self.pending_logs.extend(logs)
+
+    def cancel(self) -> None:
+        """
+        Cancels encoding any output that hasn't been sent. Uploads that have
+        already started can't be interrupted, so they're left to finish.
+        """
+        for f in self.pending_output:
+            f.cancel()
+        self.pending_output = []
+
+    def should_flush(self) -> bool:
+        n_pending = len(self.pending_output) + len(self.pending_logs)
+        if n_pending == 0:
+            return False
+        return (
+            n_pending >= self.max_items
+            or time.monotonic() - self.last_flush >= self.max_wait
+        )
+
+    def flush(self, status: str, **fields: Any) -> None:
+        """
+        Sends everything buffered so far, along with `status` and any extra
+        `fields` (e.g. `output` or `error` for the final message).
+        """
+        response = None
+        if self.pending_output or status != STATUS_PROCESSING:
+            # resolve the output before sending anything, so if an upload
+            # failed the logs are still buffered for `flush_logs()`
+            response = {
+                "status": status,
+                "seq": self.seq,
+                "new_output": [f.result() for f in self.pending_output],
+                "logs_stream": self.logs_stream,
+                **fields,
+            }
+
+        with self.redis.pipeline(transaction=False) as pipe:
+            self._add_logs_to_stream(pipe)
+            if response is not None:
+                pipe.rpush(self.response_queue, dumps_response(response))
+            pipe.execute()
+
+        if response is not None:
+            self.seq += 1
+        self.pending_output = []
+        self.pending_logs = []
+        self.last_flush = time.monotonic()
+
+    def flush_logs(self) -> None:
+        """
+        Sends any buffered logs to the logs stream without sending a message,
+        e.g. when the prediction failed before its final message was sent.
+        """
+        if not self.pending_logs:
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            self._add_logs_to_stream(pipe)
+            pipe.execute()
+        self.pending_logs = []
+
+    def _add_logs_to_stream(self, pipe: Any) -> None:
+        for line in self.pending_logs:
+            pipe.xadd(
+                self.logs_stream,
+                fields={"line": line},
+                maxlen=self.logs_stream_length,
+                approximate=True,
+            )
+        if self.pending_logs:
+            pipe.expire(self.logs_stream, self.logs_stream_ttl)
 
 
 class RedisQueueWorker:
@@ -55,6 +230,29 @@ class RedisQueueWorker:
     RUN_TIME_QUEUE_SUFFIX = "-run-time"
     STAGE_SETUP = "setup"
     STAGE_RUN = "run"
+    REDIS_MAX_CONNECTIONS = 16
+    HTTP_POOL_MAX_SIZE = 32
+    UPLOAD_WORKERS = 8
+    # milliseconds to block waiting for a message on the input queue
+    BLOCK_TIMEOUT = 30000
+    # only check for abandoned messages to autoclaim every this many reads
+    AUTOCLAIM_INTERVAL = 32
+    # how long to block waiting for the predictor subprocess before
+    # re-checking whether it's still processing
+    POLL_TIMEOUT = 0.05
+    # exponential backoff for when the subprocess wakes us up but there's
+    # nothing to read
+    MIN_BACKOFF = 0.001
+    MAX_BACKOFF = 0.1
+    BACKOFF_MULTIPLIER = 1.5
+    # batch output and logs into one response message until this many are
+    # waiting, or this many seconds have passed since the last message
+    FLUSH_MAX_ITEMS = 16
+    FLUSH_MAX_WAIT = 0.1
+    # approximate number of log lines to keep in each prediction's logs stream
+    LOGS_STREAM_LENGTH = 1000
+    # seconds to keep each prediction's logs stream after its last log line
+    LOGS_STREAM_TTL = 24 * 60 * 60
 
     def __init__(
         self,
@@ -85,13 +283,43 @@ class RedisQueueWorker:
         # Set up types
         self.InputType = get_input_type(predictor)
 
-        self.redis = redis.Redis(
-            host=self.redis_host, port=self.redis_port, db=self.redis_db
+        pool = redis.ConnectionPool(
+            host=self.redis_host,
+            port=self.redis_port,
+            db=self.redis_db,
+            max_connections=self.REDIS_MAX_CONNECTIONS,
+            # decode replies in the protocol parser (hiredis, if it's
+            # installed) rather than calling .decode() on each one
+            decode_responses=True,
         )
+        self.redis = redis.Redis(connection_pool=pool)
+
+        # encode outputs from generators in the background, so slow uploads
+        # overlap with each other and with the prediction
+        self.upload_pool = ThreadPoolExecutor(max_workers=self.UPLOAD_WORKERS)
+
+        # reuse connections for downloading inputs and uploading outputs
+        self.http = requests.Session()
+        self.http.mount("http://", HTTPAdapter(pool_maxsize=self.HTTP_POOL_MAX_SIZE))
+        self.http.mount("https://", HTTPAdapter(pool_maxsize=self.HTTP_POOL_MAX_SIZE))
         self.should_exit = False
+        # whether we're blocked reading from the input queue, which is the
+        # only time it's safe for signal_exit() to disconnect from Redis
+        self.waiting_for_message = False
+        # the client for blocking reads, created on first use so it doesn't
+        # connect as soon as the worker is created
+        self.blocking_redis: Optional[redis.Redis] = None
+        self.receive_count = 0
+        # messages we've read from the stream but haven't handled yet
+        self.received_messages: List[Tuple[str, str]] = []
         self.setup_time_queue = input_queue + self.SETUP_TIME_QUEUE_SUFFIX
         self.predict_time_queue = input_queue + self.RUN_TIME_QUEUE_SUFFIX
+        # the stats streams are trimmed approximately (`MAXLEN ~`), so Redis
+        # can drop whole macro nodes rather than trimming exactly each time
         self.stats_queue_length = 100
+        # logged once per message, so write it straight to the stderr file
+        # descriptor rather than going through sys.stderr's text wrapper
+        self.received_message_log = f"Received message on {self.input_queue}\n".encode()
 
         sys.stderr.write(
             f"Connected to Redis: {self.redis_host}:{self.redis_port} (db {self.redis_db})\n"
@@ -100,39 +328,110 @@ class RedisQueueWorker:
     def signal_exit(self, signum: Any, frame: Any) -> None:
         self.should_exit = True
         sys.stderr.write("Caught SIGTERM, exiting...\n")
+        # interrupt the blocking read on the input queue so we don't wait for
+        # it to time out. mid-prediction, leave the connections alone so the
+        # response and ack still get sent, and the main loop exits after.
+        #
+        # this runs in a signal handler, so it mustn't take any locks the
+        # interrupted code might be holding, like the connection pool's. shut
+        # down the blocking connection's socket directly instead
+        if self.waiting_for_message and self.blocking_redis is not None:
+            # `connection` is only set on single connection clients, and isn't
+            # in the type stubs
+            connection = getattr(self.blocking_redis, "connection", None)
+            sock = getattr(connection, "_sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
     def receive_message(self) -> Tuple[Optional[str], Optional[str]]:
-        # first, try to autoclaim old messages from pending queue
-        raw_messages = self.redis.execute_command(
-            "XAUTOCLAIM",
-            self.input_queue,
-            self.input_queue,
-            self.consumer_id,
-            str(self.max_processing_time * 1000),
-            "0-0",
-            "COUNT",
-            1,
-        )
-        # format: [[b'1619393873567-0', [b'mykey', b'myval']]]
-        if raw_messages and raw_messages[0] is not None:
-            key, raw_message = raw_messages[0]
-            assert raw_message[0] == b"value"
-            return key.decode(), raw_message[1].decode()
-
-        # if no old messages exist, get message from main queue
-        raw_messages = self.redis.xreadgroup(
-            groupname=self.input_queue,
-            consumername=self.consumer_id,
-            streams={self.input_queue: ">"},
-            count=1,
-            block=1000,
-        )
-        if not raw_messages:
+        if self.received_messages:
+            return self.received_messages.pop(0)
+
+        should_autoclaim = self.receive_count % self.AUTOCLAIM_INTERVAL == 0
+        self.receive_count += 1
+
+        if should_autoclaim:
+            # try to autoclaim old messages from pending queue, and check the
+            # main queue in the same round trip
+            with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xautoclaim(
+                    self.input_queue,
+                    self.input_queue,
+                    self.consumer_id,
+                    min_idle_time=self.max_processing_time * 1000,
+                    start_id=0,
+                    count=1,
+                )
+                pipe.xreadgroup(
+                    groupname=self.input_queue,
+                    consumername=self.consumer_id,
+                    streams={self.input_queue: ">"},
+                    count=1,
+                )
+                raw_claimed, raw_read = pipe.execute()
+
+            messages = self._parse_autoclaim(raw_claimed) + self._parse_xreadgroup(
+                raw_read
+            )
+            if messages:
+                # anything we've read from the main queue is now pending for
+                # this consumer, so hold on to it for the next call. start()
+                # handles these before exiting, so they don't get stuck
+                self.received_messages.extend(messages[1:])
+                return messages[0]
+
+        # if no old messages exist, block on the main queue, on a connection of
+        # its own that signal_exit() can interrupt
+        if self.blocking_redis is None:
+            self.blocking_redis = redis.Redis(
+                connection_pool=self.redis.connection_pool,
+                single_connection_client=True,
+            )
+        self.waiting_for_message = True
+        try:
+            if self.should_exit:
+                return None, None
+            raw_messages = self.blocking_redis.xreadgroup(
+                groupname=self.input_queue,
+                consumername=self.consumer_id,
+                streams={self.input_queue: ">"},
+                count=1,
+                block=self.BLOCK_TIMEOUT,
+            )
+        except redis.ConnectionError:
+            # signal_exit() shut down the socket to interrupt the read
+            if self.should_exit:
+                return None, None
+            raise
+        finally:
+            self.waiting_for_message = False
+        messages = self._parse_xreadgroup(raw_messages)
+        if not messages:
             return None, None
+        return messages[0]
+
+    def _parse_autoclaim(self, raw_messages: Any) -> List[Tuple[str, str]]:
+        # redis-py 4.1 format: [('1619393873567-0', {'mykey': 'myval'})]
+        # later 4.x format: ['0-0', [('1619393873567-0', {'mykey': 'myval'})], []]
+        if raw_messages and isinstance(raw_messages[0], (str, bytes)):
+            raw_messages = raw_messages[1]
+        # messages that were deleted while pending have no fields
+        return [
+            (key, raw_message["value"])
+            for key, raw_message in raw_messages
+            if raw_message is not None
+        ]
+
+    def _parse_xreadgroup(self, raw_messages: Any) -> List[Tuple[str, str]]:
+        if not raw_messages:
+            return []
 
-        # format: [[b'mystream', [(b'1619395583065-0', {b'mykey': b'myval6'})]]]
+        # format: [['mystream', [('1619395583065-0', {'mykey': 'myval6'})]]]
         key, raw_message = raw_messages[0][1][0]
-        return key.decode(), raw_message[b"value"].decode()
+        return [(key, raw_message["value"])]
 
     def start(self) -> None:
         signal.signal(signal.SIGTERM, self.signal_exit)
@@ -146,39 +445,58 @@ class RedisQueueWorker:
             self.setup_time_queue,
             fields={"duration": setup_time},
             maxlen=self.stats_queue_length,
+            approximate=True,
         )
         sys.stderr.write(f"Setup time: {setup_time:.2f}\n")
 
         sys.stderr.write(f"Waiting for message on {self.input_queue}\n")
-        while not self.should_exit:
+        # keep going after SIGTERM until we've handled any messages we've
+        # already read, otherwise they're stuck pending for this consumer
+        while not self.should_exit or self.received_messages:
             try:
                 message_id, message_json = self.receive_message()
                 if message_json is None:
-                    # tight loop in order to respect self.should_exit
+                    # the blocking read timed out, or was interrupted by
+                    # SIGTERM, so check self.should_exit again
                     continue
 
-                message = json.loads(message_json)
-                response_queue = message["response_queue"]
-                sys.stderr.write(f"Received message on {self.input_queue}\n")
                 cleanup_functions: List[Callable] = []
+                response_queue: Optional[str] = None
                 try:
+                    # json rather than orjson: orjson turns ints that don't fit
+                    # in 64 bits into floats, and rejects NaN and Infinity
+                    message = json.loads(message_json)
+                    queue: str = message["response_queue"]
+                    response_queue = queue
+                    os.write(2, self.received_message_log)
                     start_time = time.time()
-                    self.handle_message(response_queue, message, cleanup_functions)
-                    self.redis.xack(self.input_queue, self.input_queue, message_id)
-                    self.redis.xdel(
-                        self.input_queue, message_id
-                    )  # xdel to be able to get stream size
+                    self.handle_message(queue, message, cleanup_functions)
                     run_time = time.time() - start_time
-                    self.redis.xadd(
-                        self.predict_time_queue,
-                        fields={"duration": run_time},
-                        maxlen=self.stats_queue_length,
-                    )
-                    sys.stderr.write(f"Run time: {run_time:.2f}\n")
+                    with self.redis.pipeline(transaction=False) as pipe:
+                        pipe.xack(self.input_queue, self.input_queue, message_id)
+                        pipe.xdel(
+                            self.input_queue, message_id
+                        )  # xdel to be able to get stream size
+                        pipe.xadd(
+                            self.predict_time_queue,
+                            fields={"duration": run_time},
+                            maxlen=self.stats_queue_length,
+                            approximate=True,
+                        )
+                        pipe.execute()
+                    os.write(2, b"Run time: %.2f\n" % run_time)
                 except Exception as e:
-                    self.push_error(response_queue, e)
-                    self.redis.xack(self.input_queue, self.input_queue, message_id)
-                    self.redis.xdel(self.input_queue, message_id)
+                    if response_queue is None:
+                        # we can't tell anyone, but ack it anyway so it isn't
+                        # autoclaimed and retried forever
+                        sys.stderr.write(f"Failed to parse message {message_id}:\n")
+                        traceback.print_exc(file=sys.stderr)
+                    else:
+                        self.push_error(response_queue, e)
+                    with self.redis.pipeline(transaction=False) as pipe:
+                        pipe.xack(self.input_queue, self.input_queue, message_id)
+                        pipe.xdel(self.input_queue, message_id)
+                        pipe.execute()
                 finally:
                     for cleanup_function in cleanup_functions:
                         try:
@@ -186,8 +504,8 @@ class RedisQueueWorker:
                         except Exception as e:
                             sys.stderr.write(f"Cleanup function caught error: {e}")
             except Exception as e:
-                tb = traceback.format_exc()
-                sys.stderr.write(f"Failed to handle message: {tb}\n")
+                sys.stderr.write("Failed to handle message:\n")
+                traceback.print_exc(file=sys.stderr)
 
     def handle_message(
         self,
@@ -198,113 +516,146 @@ class RedisQueueWorker:
         try:
             input_obj = self.InputType(**message["input"])
         except ValidationError as e:
-            tb = traceback.format_exc()
-            sys.stderr.write(tb)
+            traceback.print_exc(file=sys.stderr)
             self.push_error(response_queue, e)
             return
 
         cleanup_functions.append(input_obj.cleanup)
 
-        start_time = time.time()
-
-        with timeout(seconds=self.predict_timeout):
-            self.runner.run(**input_obj.dict())
-
-            logs: List[str] = []
-            response = {
-                "status": Status.PROCESSING,
-                "output": None,
-                "logs": logs,
-            }
-
-            # just send logs until output starts
-            while self.runner.is_processing() and not self.runner.has_output_waiting():
-                if self.runner.has_logs_waiting():
-                    logs.extend(self.runner.read_logs())
-                    self.redis.rpush(response_queue, json.dumps(response))
-
-            if self.runner.error() is not None:
-                response["status"] = Status.FAILED
-                response["error"] = str(self.runner.error())  # type: ignore
-                self.redis.rpush(response_queue, json.dumps(response))
-                return
-
-            if self.runner.is_output_generator():
-                output = response["output"] = []
-
-                while self.runner.is_processing():
-                    if (
-                        self.runner.has_output_waiting()
-                        or self.runner.has_logs_waiting()
-                    ):
-                        new_output = [
-                            self.encode_json(o) for o in self.runner.read_output()
+        sender = ResponseSender(
+            self.redis,
+            response_queue,
+            max_items=self.FLUSH_MAX_ITEMS,
+            max_wait=self.FLUSH_MAX_WAIT,
+            logs_stream_length=self.LOGS_STREAM_LENGTH,
+            logs_stream_ttl=self.LOGS_STREAM_TTL,
+            prediction_id=message.get("id"),
+        )
+        try:
+            with timeout(seconds=self.predict_timeout):
+                self.runner.run(**input_obj.dict())
+                self._drain(sender)
+
+                # the subprocess is done, so whatever's left in the pipes goes in
+                # the final message
+                is_generator = self.runner.is_output_generator()
+                if is_generator:
+                    sender.add(
+                        output=[
+                            self.upload_pool.submit(self.encode_json, o)
+                            for o in self.runner.read_output()
                         ]
-                        new_logs = self.runner.read_logs()
-
-                        # sometimes it'll say there's output when there's none
-                        if new_output == [] and new_logs == []:
-                            continue
-
-                        output.extend(new_output)
-                        logs.extend(new_logs)
-
-                        # we could `time.sleep(0.1)` and check `is_processing()`
-                        # here to give the predictor subprocess a chance to exit
-                        # so we don't send a double message for final output, at
-                        # the cost of extra latency
-                        self.redis.rpush(response_queue, json.dumps(response))
-
-                if self.runner.error() is not None:
-                    response["status"] = Status.FAILED
-                    response["error"] = str(self.runner.error())  # type: ignore
-                    self.redis.rpush(response_queue, json.dumps(response))
-                    return
-
-                response["status"] = Status.SUCCEEDED
-                output.extend(self.encode_json(o) for o in self.runner.read_output())
-                logs.extend(self.runner.read_logs())
-                self.redis.rpush(response_queue, json.dumps(response))
-
-            else:
-                # just send logs until output ends
-                while self.runner.is_processing():
-                    if self.runner.has_logs_waiting():
-                        logs.extend(self.runner.read_logs())
-                        self.redis.rpush(response_queue, json.dumps(response))
+                    )
+                sender.add(logs=self.runner.read_logs())
 
                 if self.runner.error() is not None:
-                    response["status"] = Status.FAILED
-                    response["error"] = str(self.runner.error())  # type: ignore
-                    self.redis.rpush(response_queue, json.dumps(response))
+                    sender.flush(STATUS_FAILED, error=str(self.runner.error()))
                     return
 
-                output = self.runner.read_output()
-                assert len(output) == 1
-
-                response["status"] = Status.SUCCEEDED
-                response["output"] = self.encode_json(output[0])
-                logs.extend(self.runner.read_logs())
-                self.redis.rpush(response_queue, json.dumps(response))
+                if is_generator:
+                    sender.flush(STATUS_SUCCEEDED)
+                else:
+                    output = self.runner.read_output()
+                    assert len(output) == 1
+                    sender.flush(STATUS_SUCCEEDED, output=self.encode_json(output[0]))
+        finally:
+            # if the prediction failed, timed out, or couldn't be sent, the
+            # last logs are usually the ones that explain why, so send them
+            # anyway. but don't keep uploading output nobody will see
+            try:
+                sender.add(logs=self.runner.read_logs())
+                sender.flush_logs()
+            finally:
+                sender.cancel()
+
+    def _drain(self, sender: ResponseSender) -> None:
+        """
+        Passes logs and output to `sender` as the predictor subprocess
+        produces them, until it's done processing.
+
+        Output from generators is sent as it arrives. A single output is left
+        in the pipe for the caller to read once the prediction has finished.
+        """
+        # bind everything the loop calls, so each iteration doesn't have to
+        # look them up again
+        runner = self.runner
+        is_processing = runner.is_processing
+        has_output_waiting = runner.has_output_waiting
+        wait_for_event = runner.wait_for_event
+        read_output = runner.read_output
+        read_logs = runner.read_logs
+        is_output_generator = runner.is_output_generator
+        add = sender.add
+        should_flush = sender.should_flush
+        flush = sender.flush
+        submit = self.upload_pool.submit
+        encode = self.encode_json
+        sleep = time.sleep
+        poll_timeout = self.POLL_TIMEOUT
+        min_backoff = self.MIN_BACKOFF
+        max_backoff = self.MAX_BACKOFF
+        backoff_multiplier = self.BACKOFF_MULTIPLIER
+
+        # we don't know whether output is a generator until the first output
+        is_generator: Optional[bool] = None
+        backoff = min_backoff
+        while is_processing():
+            # once we know there's a single output, it sits in the pipe until
+            # the prediction is done, so don't wake up for it
+            include_output = is_generator is not False
+            if wait_for_event(timeout=poll_timeout, include_output=include_output):
+                if is_generator is None and has_output_waiting():
+                    is_generator = is_output_generator()
+
+                new_output: List["Future[Any]"] = []
+                if is_generator:
+                    new_output = [submit(encode, o) for o in read_output()]
+                new_logs = read_logs()
+
+                # sometimes it'll say there's output when there's none, or
+                # we're woken up by the error pipe while the subprocess
+                # finishes up. back off so we don't spin on a pipe that stays
+                # readable
+                if new_output == [] and new_logs == []:
+                    sleep(backoff)
+                    backoff = min(backoff * backoff_multiplier, max_backoff)
+                else:
+                    backoff = min_backoff
+                    add(output=new_output, logs=new_logs)
+
+            # we could `time.sleep(0.1)` and check `is_processing()` here to
+            # give the predictor subprocess a chance to exit so we don't send
+            # a double message for final output, at the cost of extra latency
+            if should_flush():
+                flush(STATUS_PROCESSING)
 
     def download(self, url: str) -> bytes:
-        resp = requests.get(url)
+        resp = self.http.get(url)
         resp.raise_for_status()
         return resp.content
 
     def push_error(self, response_queue: str, error: Any) -> None:
-        message = json.dumps(
-            {
-                "status": "failed",
-                "error": str(error),
-            }
-        )
+        # orjson refuses to encode lone surrogates, so replace anything that
+        # isn't valid unicode
+        error_message = str(error).encode("utf-8", "replace").decode("utf-8")
+        message = ERROR_RESPONSE_TEMPLATE % orjson.dumps(error_message)
         sys.stderr.write(f"Pushing error to {response_queue}\n")
         self.redis.rpush(response_queue, message)
 
     def encode_json(self, obj: Any) -> Any:
         def upload_file(fh: io.IOBase) -> str:
-            resp = requests.put(self.upload_url, files={"file": fh})
+            # the upload endpoint expects a multipart form, but `files=` would
+            # read the whole file into memory to build it, so stream it
+            name = getattr(fh, "name", None)
+            filename = os.path.basename(name) if isinstance(name, str) else "file"
+            body = MultipartEncoder(
+                fields={"file": (filename, fh, "application/octet-stream")}
+            )
+            resp = self.http.put(
+                self.upload_url,
+                data=body,
+                headers={"Content-Type": body.content_type},
+            )
             resp.raise_for_status()
             return resp.json()["url"]
 
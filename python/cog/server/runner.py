@@ -1,7 +1,7 @@
 import multiprocessing
 import types
 from enum import Enum
-from multiprocessing.connection import Connection
+from multiprocessing.connection import Connection, wait
 from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel
@@ -104,6 +104,26 @@ class PredictionRunner:
 
         return self._is_processing
 
+    def wait_for_event(
+        self, timeout: Optional[float] = None, include_output: bool = True
+    ) -> bool:
+        """
+        Blocks until the subprocess sends logs, output, an error or the done
+        token, or until `timeout` seconds have passed. Returns True if there's
+        something to read.
+
+        Pass `include_output=False` to ignore the output pipe, e.g. when
+        output is waiting but won't be read until the prediction is done.
+        """
+        readers = [
+            self.logs_pipe_reader,
+            self.error_pipe_reader,
+            self.done_pipe_reader,
+        ]
+        if include_output:
+            readers.append(self.predictor_pipe_reader)
+        return bool(wait(readers, timeout=timeout))
+
     def has_output_waiting(self) -> bool:
         return self.predictor_pipe_reader.poll()
 
@@ -17,10 +17,12 @@ setuptools.setup(
     install_requires=[
         # intentionally loose. perhaps these should be vendored to not collide with user code?
         "fastapi>=0.6,<1",
+        "orjson>=3,<4",
         "pydantic>=1,<2",
         "PyYAML",
-        "redis>=4,<5",
+        "redis[hiredis]>=4,<5",
         "requests>=2,<3",
+        "requests-toolbelt>=0.9,<2",
         "typing_extensions>=4.1.0",
         "uvicorn[standard]>=0.12,<1",
     ],
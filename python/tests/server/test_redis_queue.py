@@ -0,0 +1,589 @@
+from concurrent.futures import Future
+import io
+import json
+import signal
+import socket
+import time
+from typing import Any
+from unittest import mock
+
+import fakeredis
+import pytest
+import responses
+from requests_toolbelt import MultipartDecoder, MultipartEncoder
+
+from cog import BasePredictor, Path
+from cog.server.redis_queue import RedisQueueWorker, ResponseSender, timeout
+
+
+def done_future(result: Any) -> "Future[Any]":
+    future: "Future[Any]" = Future()
+    future.set_result(result)
+    return future
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def make_sender(redis_client, max_items=16, max_wait=60.0):
+    return ResponseSender(
+        redis_client,
+        "response-queue",
+        max_items=max_items,
+        max_wait=max_wait,
+        logs_stream_length=1000,
+        logs_stream_ttl=60,
+    )
+
+
+def make_worker(redis_client):
+    class Predictor(BasePredictor):
+        def predict(self, text: str) -> str:
+            return text
+
+    worker = RedisQueueWorker(
+        Predictor(), "localhost", 6379, "predict-queue", "", "test-worker"
+    )
+    worker.redis = redis_client
+    # fakeredis errors on blocking reads from an empty consumer group, so
+    # don't block
+    worker.BLOCK_TIMEOUT = None
+    redis_client.xgroup_create(
+        mkstream=True, groupname="predict-queue", name="predict-queue", id="$"
+    )
+    return worker
+
+
+class StubRunner:
+    """
+    Stands in for PredictionRunner without a subprocess. Each call to
+    `wait_for_event()` plays back the next step: either the `(output, logs)`
+    the predictor produced since the last one, or an exception to raise.
+    The prediction is done when there are no steps left.
+    """
+
+    def __init__(self, steps, is_generator):
+        self.steps = list(steps)
+        self.generator = is_generator
+        self.output = []
+        self.logs = []
+        self.include_output = []
+
+    def run(self, **prediction_input):
+        pass
+
+    def is_processing(self):
+        return bool(self.steps)
+
+    def wait_for_event(self, timeout=None, include_output=True):
+        self.include_output.append(include_output)
+        step = self.steps.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        output, logs = step
+        self.output.extend(output)
+        self.logs.extend(logs)
+        return True
+
+    def has_output_waiting(self):
+        return bool(self.output)
+
+    def is_output_generator(self):
+        return self.generator if self.output else None
+
+    def read_output(self):
+        output, self.output = self.output, []
+        return output
+
+    def read_logs(self):
+        logs, self.logs = self.logs, []
+        return logs
+
+    def error(self):
+        return None
+
+
+def pending_ids(redis_client, consumer):
+    return [
+        p["message_id"]
+        for p in redis_client.xpending_range(
+            "predict-queue",
+            "predict-queue",
+            min="-",
+            max="+",
+            count=10,
+            consumername=consumer,
+        )
+    ]
+
+
+def read_responses(redis_client):
+    return [json.loads(r) for r in redis_client.lrange("response-queue", 0, -1)]
+
+
+def read_logs(redis_client):
+    return [
+        fields["line"] for _, fields in redis_client.xrange("response-queue:logs")
+    ]
+
+
+def run_until_exit(worker):
+    """
+    Runs the worker's main loop with a stub handle_message() until there are
+    no messages left, and returns the messages it handled.
+    """
+    handled = []
+
+    def handle_message(response_queue, message, cleanup_functions):
+        handled.append(message)
+
+    receive_message = worker.receive_message
+
+    def receive_until_empty():
+        message = receive_message()
+        if message == (None, None):
+            worker.should_exit = True
+        return message
+
+    worker.runner.setup = lambda: None
+    worker.handle_message = handle_message
+    worker.receive_message = receive_until_empty
+    original_handler = signal.getsignal(signal.SIGTERM)
+    try:
+        worker.start()
+    finally:
+        signal.signal(signal.SIGTERM, original_handler)
+    return handled
+
+
+def test_response_sender_does_not_flush_when_empty(redis_client):
+    sender = make_sender(redis_client, max_wait=0)
+    assert not sender.should_flush()
+
+
+def test_response_sender_flushes_after_max_items(redis_client):
+    sender = make_sender(redis_client, max_items=3)
+    sender.add(output=[done_future("a")], logs=["one"])
+    assert not sender.should_flush()
+    sender.add(logs=["two"])
+    assert sender.should_flush()
+
+
+def test_response_sender_flushes_after_max_wait(redis_client):
+    sender = make_sender(redis_client, max_wait=0)
+    sender.add(logs=["one"])
+    assert sender.should_flush()
+
+
+def test_response_sender_sends_output_deltas(redis_client):
+    sender = make_sender(redis_client)
+    sender.add(output=[done_future("a"), done_future("b")])
+    sender.flush("processing")
+    sender.add(output=[done_future("c")])
+    sender.flush("succeeded")
+
+    assert read_responses(redis_client) == [
+        {
+            "status": "processing",
+            "seq": 0,
+            "new_output": ["a", "b"],
+            "logs_stream": "response-queue:logs",
+        },
+        {
+            "status": "succeeded",
+            "seq": 1,
+            "new_output": ["c"],
+            "logs_stream": "response-queue:logs",
+        },
+    ]
+    assert not sender.should_flush()
+
+
+def test_response_sender_sends_logs_to_stream_without_pushing(redis_client):
+    sender = make_sender(redis_client)
+    sender.add(logs=["one", "two"])
+    sender.flush("processing")
+
+    assert read_responses(redis_client) == []
+    assert read_logs(redis_client) == ["one", "two"]
+
+    sender.add(logs=["three"])
+    sender.flush("succeeded", output="done")
+
+    # seq only counts messages that were pushed
+    assert read_responses(redis_client) == [
+        {
+            "status": "succeeded",
+            "seq": 0,
+            "new_output": [],
+            "logs_stream": "response-queue:logs",
+            "output": "done",
+        }
+    ]
+    assert read_logs(redis_client) == ["one", "two", "three"]
+
+
+def test_response_sender_names_logs_stream_after_prediction(redis_client):
+    sender = ResponseSender(
+        redis_client,
+        "response-queue",
+        max_items=16,
+        max_wait=60,
+        logs_stream_length=1000,
+        logs_stream_ttl=60,
+        prediction_id="abc123",
+    )
+    sender.add(logs=["one"])
+    sender.flush("succeeded")
+
+    assert read_responses(redis_client)[0]["logs_stream"] == (
+        "response-queue:logs:abc123"
+    )
+    assert redis_client.xlen("response-queue:logs:abc123") == 1
+
+
+def test_response_sender_expires_logs_stream(redis_client):
+    sender = make_sender(redis_client)
+    sender.add(logs=["one"])
+    sender.flush("processing")
+
+    assert 0 < redis_client.ttl("response-queue:logs") <= 60
+
+
+def test_response_sender_encodes_ints_too_big_for_orjson(redis_client):
+    sender = make_sender(redis_client)
+    sender.add(output=[done_future(2**64)])
+    sender.flush("succeeded")
+
+    assert read_responses(redis_client)[0]["new_output"] == [2**64]
+
+
+def test_response_sender_encodes_non_finite_floats_like_json(redis_client):
+    sender = make_sender(redis_client)
+    sender.add(output=[done_future(float("nan")), done_future(float("inf"))])
+    sender.flush("succeeded", output=None)
+
+    response = redis_client.lrange("response-queue", 0, -1)[0]
+    assert '"new_output": [NaN, Infinity]' in response
+    assert '"output": null' in response
+
+
+def test_response_sender_encodes_strings_containing_null_with_orjson(
+    redis_client,
+):
+    sender = make_sender(redis_client)
+    sender.add(output=[done_future("nullable")])
+
+    with mock.patch("json.dumps", side_effect=AssertionError):
+        sender.flush("processing")
+
+    assert read_responses(redis_client)[0]["new_output"] == ["nullable"]
+
+
+def test_response_sender_cancels_unsent_output(redis_client):
+    sender = make_sender(redis_client)
+    future: "Future[Any]" = Future()
+    sender.add(output=[future], logs=["one"])
+    sender.cancel()
+
+    assert future.cancelled()
+    assert sender.pending_output == []
+
+
+def test_response_sender_keeps_logs_when_output_fails(redis_client):
+    sender = make_sender(redis_client)
+    failed: "Future[Any]" = Future()
+    failed.set_exception(IOError("upload failed"))
+    sender.add(output=[failed], logs=["one", "two"])
+
+    with pytest.raises(IOError):
+        sender.flush("succeeded")
+    sender.flush_logs()
+
+    assert read_responses(redis_client) == []
+    assert read_logs(redis_client) == ["one", "two"]
+
+
+def test_handle_message_sends_logs_when_prediction_times_out(redis_client):
+    worker = make_worker(redis_client)
+    # don't flush until the prediction's done
+    worker.FLUSH_MAX_WAIT = 60
+    worker.runner = StubRunner(
+        [([], ["one"]), ([], ["two"]), TimeoutError("Prediction timed out")],
+        is_generator=False,
+    )
+
+    with pytest.raises(TimeoutError):
+        worker.handle_message("response-queue", {"input": {"text": "hi"}}, [])
+
+    assert read_responses(redis_client) == []
+    assert read_logs(redis_client) == ["one", "two"]
+
+
+def test_drain_sends_generator_output_as_it_arrives(redis_client):
+    worker = make_worker(redis_client)
+    worker.runner = StubRunner(
+        [([], ["starting"]), (["a"], []), (["b"], ["one"])], is_generator=True
+    )
+    sender = make_sender(redis_client)
+
+    worker._drain(sender)
+
+    # the generator was spotted from the first output, so it needs waking
+    # up for the rest
+    assert worker.runner.include_output == [True, True, True]
+    assert [f.result() for f in sender.pending_output] == ["a", "b"]
+    assert sender.pending_logs == ["starting", "one"]
+
+
+def test_drain_leaves_single_output_in_the_pipe(redis_client):
+    worker = make_worker(redis_client)
+    worker.runner = StubRunner(
+        [([], ["one"]), (["output"], []), ([], ["two"])], is_generator=False
+    )
+    sender = make_sender(redis_client)
+
+    worker._drain(sender)
+
+    # once we know there's a single output, don't wake up for it
+    assert worker.runner.include_output == [True, True, False]
+    assert worker.runner.output == ["output"]
+    assert sender.pending_output == []
+    assert sender.pending_logs == ["one", "two"]
+
+
+def test_drain_backs_off_when_woken_up_for_nothing(redis_client):
+    worker = make_worker(redis_client)
+    worker.runner = StubRunner(
+        [([], []), ([], []), ([], ["one"]), ([], [])], is_generator=False
+    )
+    sender = make_sender(redis_client)
+
+    with mock.patch("time.sleep") as sleep:
+        worker._drain(sender)
+
+    assert sleep.call_args_list == [
+        mock.call(worker.MIN_BACKOFF),
+        mock.call(worker.MIN_BACKOFF * worker.BACKOFF_MULTIPLIER),
+        # reset after reading something
+        mock.call(worker.MIN_BACKOFF),
+    ]
+
+
+def test_drain_flushes_logs_while_processing(redis_client):
+    worker = make_worker(redis_client)
+    worker.runner = StubRunner(
+        [([], ["one"]), ([], ["two"]), ([], ["three"])], is_generator=False
+    )
+    sender = make_sender(redis_client, max_items=2)
+
+    worker._drain(sender)
+
+    assert read_logs(redis_client) == ["one", "two"]
+    # there's no new output, so there's no message
+    assert read_responses(redis_client) == []
+    assert sender.pending_logs == ["three"]
+
+
+def add_upload_callback(uploads):
+    """
+    Accepts uploads to http://example.com/upload, adding the filename and
+    contents of each one's file part to `uploads`.
+    """
+
+    def callback(request):
+        # newer versions of responses read streamed bodies before calling this
+        body = request.body
+        if not isinstance(body, bytes):
+            body = body.read()
+        assert request.headers["Content-Length"] == str(len(body))
+        part = MultipartDecoder(body, request.headers["Content-Type"]).parts[0]
+        uploads.append((part.headers[b"Content-Disposition"], part.content))
+        return (200, {}, json.dumps({"url": "http://example.com/uploaded"}))
+
+    responses.add_callback(
+        responses.PUT, "http://example.com/upload", callback=callback
+    )
+
+
+def make_upload_worker(redis_client):
+    worker = make_worker(redis_client)
+    worker.upload_url = "http://example.com/upload"
+    worker.http.put = mock.Mock(wraps=worker.http.put)
+    return worker
+
+
+def assert_upload_was_streamed(worker):
+    # requests sets Content-Length from the encoder's length, and reads it as
+    # it sends, rather than reading the whole body up front
+    body = worker.http.put.call_args[1]["data"]
+    assert isinstance(body, MultipartEncoder)
+
+
+@responses.activate
+def test_encode_json_streams_files_as_multipart(redis_client, tmp_path):
+    worker = make_upload_worker(redis_client)
+    uploads = []
+    add_upload_callback(uploads)
+    path = tmp_path / "my_file.txt"
+    path.write_bytes(b"hello")
+
+    assert worker.encode_json(Path(path)) == "http://example.com/uploaded"
+    assert uploads == [(b'form-data; name="file"; filename="my_file.txt"', b"hello")]
+    assert_upload_was_streamed(worker)
+
+
+@responses.activate
+def test_encode_json_names_unnamed_files(redis_client):
+    worker = make_upload_worker(redis_client)
+    uploads = []
+    add_upload_callback(uploads)
+
+    assert worker.encode_json(io.BytesIO(b"hello")) == "http://example.com/uploaded"
+    assert uploads == [(b'form-data; name="file"; filename="file"', b"hello")]
+    assert_upload_was_streamed(worker)
+
+
+def test_receive_message_reads_main_queue(redis_client):
+    worker = make_worker(redis_client)
+    message_id = redis_client.xadd("predict-queue", {"value": "fresh"})
+
+    assert worker.receive_message() == (message_id, "fresh")
+    assert worker.receive_message() == (None, None)
+
+
+def test_receive_message_autoclaims_abandoned_message(redis_client):
+    worker = make_worker(redis_client)
+    worker.max_processing_time = 0
+    message_id = redis_client.xadd("predict-queue", {"value": "abandoned"})
+    redis_client.xreadgroup("predict-queue", "dead-worker", {"predict-queue": ">"})
+
+    assert worker.receive_message() == (message_id, "abandoned")
+    assert pending_ids(redis_client, "dead-worker") == []
+    assert pending_ids(redis_client, "test-worker") == [message_id]
+
+
+def test_receive_message_keeps_message_read_alongside_autoclaim(redis_client):
+    worker = make_worker(redis_client)
+    worker.max_processing_time = 0
+    abandoned_id = redis_client.xadd("predict-queue", {"value": "abandoned"})
+    redis_client.xreadgroup("predict-queue", "dead-worker", {"predict-queue": ">"})
+    fresh_id = redis_client.xadd("predict-queue", {"value": "fresh"})
+
+    # the autoclaim and the read from the main queue are pipelined together
+    assert worker.receive_message() == (abandoned_id, "abandoned")
+    assert worker.received_messages == [(fresh_id, "fresh")]
+    assert worker.receive_message() == (fresh_id, "fresh")
+    assert pending_ids(redis_client, "test-worker") == [abandoned_id, fresh_id]
+
+
+@pytest.mark.parametrize(
+    "raw_claimed",
+    [
+        # redis-py 4.1
+        [("1-0", {"value": "abandoned"}), ("2-0", None)],
+        # later redis-py 4.x
+        ["0-0", [("1-0", {"value": "abandoned"}), ("2-0", None)], []],
+    ],
+)
+def test_parse_autoclaim_reads_both_reply_formats(redis_client, raw_claimed):
+    worker = make_worker(redis_client)
+
+    assert worker._parse_autoclaim(raw_claimed) == [("1-0", "abandoned")]
+    assert worker._parse_autoclaim([]) == []
+    assert worker._parse_autoclaim(["0-0", [], []]) == []
+
+
+def test_signal_exit_interrupts_blocking_read_without_the_pool(redis_client):
+    worker = make_worker(redis_client)
+    worker.blocking_redis = mock.Mock()
+    worker.redis = mock.Mock()
+    worker.waiting_for_message = True
+
+    worker.signal_exit(signal.SIGTERM, None)
+
+    assert worker.should_exit
+    worker.blocking_redis.connection._sock.shutdown.assert_called_once_with(
+        socket.SHUT_RDWR
+    )
+    assert worker.redis.mock_calls == []
+
+
+def test_signal_exit_leaves_connections_alone_mid_prediction(redis_client):
+    worker = make_worker(redis_client)
+    worker.blocking_redis = mock.Mock()
+
+    worker.signal_exit(signal.SIGTERM, None)
+
+    assert worker.should_exit
+    assert worker.blocking_redis.mock_calls == []
+
+
+def test_start_handles_received_messages_before_exiting(redis_client):
+    worker = make_worker(redis_client)
+    worker.max_processing_time = 0
+    abandoned_id = redis_client.xadd("predict-queue", {"value": "abandoned"})
+    redis_client.xreadgroup("predict-queue", "dead-worker", {"predict-queue": ">"})
+    message = json.dumps({"input": {"text": "hi"}, "response_queue": "responses"})
+    fresh_id = redis_client.xadd("predict-queue", {"value": message})
+    assert worker.receive_message() == (abandoned_id, "abandoned")
+
+    # SIGTERM has already arrived
+    worker.should_exit = True
+    handled = run_until_exit(worker)
+
+    assert handled == [{"input": {"text": "hi"}, "response_queue": "responses"}]
+    assert fresh_id not in pending_ids(redis_client, "test-worker")
+
+
+def test_start_keeps_ints_too_big_for_orjson_in_messages(redis_client):
+    worker = make_worker(redis_client)
+    message = '{"input": {"n": 123456789012345678901234567}, "response_queue": "r"}'
+    redis_client.xadd("predict-queue", {"value": message})
+
+    handled = run_until_exit(worker)
+
+    assert handled[0]["input"]["n"] == 123456789012345678901234567
+
+
+def test_start_acks_messages_it_cant_parse(redis_client):
+    worker = make_worker(redis_client)
+    redis_client.xadd("predict-queue", {"value": "{not json"})
+    redis_client.xadd("predict-queue", {"value": '{"input": {}}'})
+
+    handled = run_until_exit(worker)
+
+    assert handled == []
+    assert pending_ids(redis_client, "test-worker") == []
+    assert redis_client.xlen("predict-queue") == 0
+
+
+def test_timeout_has_sub_second_resolution():
+    start = time.monotonic()
+    with pytest.raises(TimeoutError, match="Prediction timed out"):
+        with timeout(seconds=0.2):
+            time.sleep(1)
+    assert time.monotonic() - start < 0.5
+
+
+def test_timeout_subtracts_fractional_elapsed_time():
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        with timeout(seconds=1, elapsed=0.8):
+            time.sleep(1)
+    assert time.monotonic() - start < 0.5
+
+
+def test_timeout_is_cleared_on_exit():
+    with timeout(seconds=0.1):
+        pass
+    time.sleep(0.2)
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+
+
+def test_timeout_raises_immediately_when_already_elapsed():
+    with pytest.raises(TimeoutError):
+        with timeout(seconds=1, elapsed=2):
+            pass
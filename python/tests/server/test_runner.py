@@ -0,0 +1,42 @@
+import time
+
+from cog.server.runner import PredictionRunner
+
+
+def test_wait_for_event_returns_when_logs_are_written():
+    runner = PredictionRunner()
+    runner.logs_pipe_writer.send("a log line")
+
+    assert runner.wait_for_event(timeout=1)
+
+
+def test_wait_for_event_returns_when_done_is_written():
+    runner = PredictionRunner()
+    runner.done_pipe_writer.send(PredictionRunner.PREDICTION_DONE)
+
+    assert runner.wait_for_event(timeout=1)
+
+
+def test_wait_for_event_times_out_when_nothing_is_written():
+    runner = PredictionRunner()
+
+    start_time = time.time()
+    assert not runner.wait_for_event(timeout=0.1)
+    assert time.time() - start_time >= 0.1
+
+
+def test_wait_for_event_returns_when_output_is_written():
+    runner = PredictionRunner()
+    runner.predictor_pipe_writer.send("output")
+
+    assert runner.wait_for_event(timeout=1)
+
+
+def test_wait_for_event_ignores_output_unless_included():
+    runner = PredictionRunner()
+    runner.predictor_pipe_writer.send("output")
+
+    assert not runner.wait_for_event(timeout=0.1, include_output=False)
+
+    runner.logs_pipe_writer.send("a log line")
+    assert runner.wait_for_event(timeout=1, include_output=False)
@@ -5,6 +5,29 @@ import subprocess
 from .util import docker_run, random_string
 
 
+def read_responses(redis_client, response_queue):
+    """
+    Pops response messages in the order they were sent, until the prediction
+    has succeeded or failed.
+    """
+    responses = []
+    while True:
+        response = json.loads(redis_client.blpop(response_queue, timeout=10)[1])
+        responses.append(response)
+        if response["status"] != "processing":
+            return responses
+
+
+def concat(responses, key):
+    return [item for response in responses for item in response[key]]
+
+
+def read_logs(redis_client, logs_stream):
+    return [
+        fields[b"line"].decode() for _, fields in redis_client.xrange(logs_stream)
+    ]
+
+
 def test_queue_worker_files(docker_image, docker_network, redis_client, upload_server):
     project_dir = Path(__file__).parent / "fixtures/file-project"
     subprocess.run(["cog", "build", "-t", docker_image], check=True, cwd=project_dir)
@@ -52,8 +75,10 @@ def test_queue_worker_files(docker_image, docker_network, redis_client, upload_s
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "succeeded",
+            "seq": 0,
+            "new_output": [],
+            "logs_stream": f"response-queue:logs:{predict_id}",
             "output": "http://upload-server:5000/download/output.txt",
-            "logs": [],
         }
 
         with open(upload_server / "output.txt") as f:
@@ -109,8 +134,9 @@ def test_queue_worker_yielding_file(
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "processing",
-            "output": ["http://upload-server:5000/download/out-0.txt"],
-            "logs": [],
+            "seq": 0,
+            "new_output": ["http://upload-server:5000/download/out-0.txt"],
+            "logs_stream": f"response-queue:logs:{predict_id}",
         }
 
         with open(upload_server / "out-0.txt") as f:
@@ -119,11 +145,9 @@ def test_queue_worker_yielding_file(
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "processing",
-            "output": [
-                "http://upload-server:5000/download/out-0.txt",
-                "http://upload-server:5000/download/out-1.txt",
-            ],
-            "logs": [],
+            "seq": 1,
+            "new_output": ["http://upload-server:5000/download/out-1.txt"],
+            "logs_stream": f"response-queue:logs:{predict_id}",
         }
 
         with open(upload_server / "out-1.txt") as f:
@@ -132,12 +156,9 @@ def test_queue_worker_yielding_file(
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "processing",
-            "output": [
-                "http://upload-server:5000/download/out-0.txt",
-                "http://upload-server:5000/download/out-1.txt",
-                "http://upload-server:5000/download/out-2.txt",
-            ],
-            "logs": [],
+            "seq": 2,
+            "new_output": ["http://upload-server:5000/download/out-2.txt"],
+            "logs_stream": f"response-queue:logs:{predict_id}",
         }
 
         with open(upload_server / "out-2.txt") as f:
@@ -146,12 +167,9 @@ def test_queue_worker_yielding_file(
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "succeeded",
-            "output": [
-                "http://upload-server:5000/download/out-0.txt",
-                "http://upload-server:5000/download/out-1.txt",
-                "http://upload-server:5000/download/out-2.txt",
-            ],
-            "logs": [],
+            "seq": 3,
+            "new_output": [],
+            "logs_stream": f"response-queue:logs:{predict_id}",
         }
 
         response = redis_client.rpop("response-queue")
@@ -199,19 +217,13 @@ def test_queue_worker_yielding(docker_network, docker_image, redis_client):
             },
         )
 
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {
-            "status": "processing",
-            "output": ["foo", "bar", "baz"],
-            "logs": [],
-        }
-
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {
-            "status": "succeeded",
-            "output": ["foo", "bar", "baz"],
-            "logs": [],
-        }
+        # all the output arrives at once, so it may or may not be batched
+        # into the final message
+        responses = read_responses(redis_client, "response-queue")
+        assert [r["seq"] for r in responses] == list(range(len(responses)))
+        assert responses[-1]["status"] == "succeeded"
+        assert concat(responses, "new_output") == ["foo", "bar", "baz"]
+        assert read_logs(redis_client, f"response-queue:logs:{predict_id}") == []
 
         response = redis_client.rpop("response-queue")
         assert response == None
@@ -261,8 +273,9 @@ def test_queue_worker_error(docker_network, docker_image, redis_client):
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "failed",
-            "output": None,
-            "logs": [],
+            "seq": 0,
+            "new_output": [],
+            "logs_stream": f"response-queue:logs:{predict_id}",
             "error": "over budget",
         }
 
@@ -314,25 +327,24 @@ def test_queue_worker_error_after_output(docker_network, docker_image, redis_cli
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "processing",
-            "output": ["hello bar"],
-            "logs": [],
-        }
-
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {
-            "status": "processing",
-            "output": ["hello bar"],
-            "logs": ["a printed log message"],
+            "seq": 0,
+            "new_output": ["hello bar"],
+            "logs_stream": f"response-queue:logs:{predict_id}",
         }
 
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "failed",
-            "output": ["hello bar"],
-            "logs": ["a printed log message"],
+            "seq": 1,
+            "new_output": [],
+            "logs_stream": f"response-queue:logs:{predict_id}",
             "error": "mid run error",
         }
 
+        assert read_logs(redis_client, f"response-queue:logs:{predict_id}") == [
+            "a printed log message"
+        ]
+
         response = redis_client.rpop("response-queue")
         assert response == None
 
@@ -425,60 +437,23 @@ def test_queue_worker_logging(docker_network, docker_image, redis_client):
             },
         )
 
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {
-            "status": "processing",
-            "output": None,
-            "logs": [
-                "WARNING:root:writing log message",
-            ],
-        }
-
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {
-            "status": "processing",
-            "output": None,
-            "logs": [
-                "WARNING:root:writing log message",
-                "writing from C",
-            ],
-        }
-
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {
-            "status": "processing",
-            "output": None,
-            "logs": [
-                "WARNING:root:writing log message",
-                "writing from C",
-                "writing to stderr",
-            ],
-        }
-
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {
-            "status": "processing",
-            "output": None,
-            "logs": [
-                "WARNING:root:writing log message",
-                "writing from C",
-                "writing to stderr",
-                "writing with print",
-            ],
-        }
-
+        # logs go to the logs stream, so the only message is the output
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "succeeded",
+            "seq": 0,
+            "new_output": [],
+            "logs_stream": f"response-queue:logs:{predict_id}",
             "output": "output",
-            "logs": [
-                "WARNING:root:writing log message",
-                "writing from C",
-                "writing to stderr",
-                "writing with print",
-            ],
         }
 
+        assert read_logs(redis_client, f"response-queue:logs:{predict_id}") == [
+            "WARNING:root:writing log message",
+            "writing from C",
+            "writing to stderr",
+            "writing with print",
+        ]
+
         response = redis_client.rpop("response-queue")
         assert response == None
 
@@ -526,7 +501,13 @@ def test_queue_worker_timeout(docker_network, docker_image, redis_client):
         )
 
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {"status": "succeeded", "output": "it worked!", "logs": []}
+        assert response == {
+            "status": "succeeded",
+            "seq": 0,
+            "new_output": [],
+            "logs_stream": f"response-queue:logs:{predict_id}",
+            "output": "it worked!",
+        }
 
         predict_id = random_string(10)
         redis_client.xadd(
@@ -591,11 +572,9 @@ def test_queue_worker_yielding_timeout(docker_image, docker_network, redis_clien
             },
         )
 
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {"status": "processing", "output": ["yield 0"], "logs": []}
-
-        response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {"status": "succeeded", "output": ["yield 0"], "logs": []}
+        responses = read_responses(redis_client, "response-queue")
+        assert responses[-1]["status"] == "succeeded"
+        assert concat(responses, "new_output") == ["yield 0"]
 
         predict_id = random_string(10)
         redis_client.xadd(
@@ -616,13 +595,19 @@ def test_queue_worker_yielding_timeout(docker_image, docker_network, redis_clien
 
         # TODO(andreas): revisit this test design if it starts being flakey
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
-        assert response == {"status": "processing", "output": ["yield 0"], "logs": []}
+        assert response == {
+            "status": "processing",
+            "seq": 0,
+            "new_output": ["yield 0"],
+            "logs_stream": f"response-queue:logs:{predict_id}",
+        }
 
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "processing",
-            "output": ["yield 0", "yield 1"],
-            "logs": [],
+            "seq": 1,
+            "new_output": ["yield 1"],
+            "logs_stream": f"response-queue:logs:{predict_id}",
         }
 
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
@@ -673,11 +658,13 @@ def test_queue_worker_complex_output(docker_network, docker_image, redis_client)
         response = json.loads(redis_client.brpop("response-queue", timeout=10)[1])
         assert response == {
             "status": "succeeded",
+            "seq": 0,
+            "new_output": [],
+            "logs_stream": f"response-queue:logs:{predict_id}",
             "output": {
                 "hello": "hello world",
                 "goodbye": "goodbye world",
             },
-            "logs": [],
         }
 
         response = redis_client.rpop("response-queue")